@@ -6,134 +6,348 @@ Processes shards individually and merges at the end.
 
 import sys
 import os
+import re
 from pathlib import Path
 import struct
-import subprocess
 import io
 import tempfile
+import shutil
 import heapq
-from collections import defaultdict
+import multiprocessing
+from itertools import chain, islice
+from functools import partial
 
 try:
     import chess
-    import chess.pgn
     import chess.polyglot
 except ImportError:
     print("Error: python-chess is required. Install with: pip3 install python-chess")
     sys.exit(1)
 
-def process_game(game, position_stats, max_ply=60):
-    """Process a single game and update position statistics."""
-    board = game.board()
-    moves = list(game.mainline_moves())
-    
-    if len(moves) == 0:
-        return
+try:
+    import numpy as np
+except ImportError:
+    print("Error: numpy is required. Install with: pip3 install numpy")
+    sys.exit(1)
+
+try:
+    import zstandard
+except ImportError:
+    print("Error: zstandard is required. Install with: pip3 install zstandard")
+    sys.exit(1)
+
+# On-disk Polyglot entry layout, equivalent to struct format '>QHHHh'
+ENTRY_DTYPE = np.dtype([('key', '>u8'), ('move', '>u2'), ('cnt', '>u2'),
+                        ('n', '>u2'), ('sum', '>i2')])
+
+# Precompiled struct for the same entry layout
+ENTRY_STRUCT = struct.Struct('>QHHHh')
+
+# Entries buffered per merge input (4 MB blocks)
+MERGE_BLOCK_ENTRIES = (4 * 1024 * 1024) // ENTRY_DTYPE.itemsize
+
+# Merged entries buffered before each output flush
+MERGE_OUTPUT_ENTRIES = 1_000_000
+
+# Keys sampled per book when choosing key-range split points
+MERGE_SPLIT_SAMPLES = 1024
+
+# Compressed bytes pulled from a shard per decompressor read
+ZSTD_READ_SIZE = 4 * 1024 * 1024
+
+# Per-process decompression context, reused across shards
+_DCTX = None
+
+_COMMENT_RE = re.compile(r'\{[^}]*\}')
+_MOVE_NUMBER_RE = re.compile(r'\d+\.+')
+_RESULTS = frozenset(('1-0', '0-1', '1/2-1/2', '*'))
+
+# Polyglot promotion code indexed by piece type:
+# None, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+_PROMO = (0, 0, 1, 2, 3, 4, 0)
+
+def iter_games(stream, max_ply=None):
+    """
+    Yield the mainline SAN moves of each game in a PGN text stream.
+    Headers, comments ({...} and ;...), escape lines, NAGs and variations
+    are skipped without building any Game/Node objects. Games starting
+    from a custom FEN are dropped. With max_ply set, moves past that ply
+    are scanned over but not collected.
+    """
+    sans = []
+    in_movetext = False
+    in_comment = False
+    custom_start = False
+    depth = 0
+
+    for line in stream:
+        if in_comment:
+            end = line.find('}')
+            if end < 0:
+                continue
+            line = line[end + 1:]
+            in_comment = False
+
+        if line.startswith('%'):
+            continue
+
+        if line.startswith('['):
+            if in_movetext:
+                # Game without a result token; flush it before the next one
+                if not custom_start:
+                    yield sans
+                sans = []
+                in_movetext = False
+                custom_start = False
+                depth = 0
+            if line.startswith('[FEN '):
+                custom_start = True
+            continue
+
+        if '{' in line:
+            line = _COMMENT_RE.sub(' ', line)
+        if ';' in line:
+            # Rest-of-line comment; closed {...} comments are already gone,
+            # so any brace after this point belongs to the ';' comment
+            line = line[:line.find(';')]
+        if '{' in line:
+            line = line[:line.find('{')]
+            in_comment = True
+        if '(' in line or ')' in line:
+            line = line.replace('(', ' ( ').replace(')', ' ) ')
+
+        for token in line.split():
+            in_movetext = True
+            if token == '(':
+                depth += 1
+                continue
+            if token == ')':
+                # Clamp so a stray ')' cannot pull later variations into the mainline
+                if depth > 0:
+                    depth -= 1
+                continue
+            if depth > 0:
+                continue
+            if token in _RESULTS:
+                if not custom_start:
+                    yield sans
+                sans = []
+                in_movetext = False
+                custom_start = False
+                depth = 0
+                continue
+            m = _MOVE_NUMBER_RE.match(token)
+            if m:
+                token = token[m.end():]
+                if not token:
+                    continue
+            if token[0] == '$':
+                continue
+            if max_ply is None or len(sans) < max_ply:
+                sans.append(token.rstrip('!?'))
+
+    if in_movetext and not custom_start:
+        yield sans
+
+class IncrementalZobrist:
+    """
+    Polyglot Zobrist key maintained across moves. Only the piece-square
+    terms a move touches are XORed in and out; the castling, en passant
+    and turn terms are O(1) and recomputed after each push. Matches
+    chess.polyglot.zobrist_hash for standard (non-960) games.
+    """
+
+    _random = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+    _hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+    def __init__(self, board):
+        self.pieces = self._hasher.hash_board(board)
+        self.key = self.pieces ^ self._state(board)
+
+    def _state(self, board):
+        hasher = self._hasher
+        return (hasher.hash_castling(board) ^ hasher.hash_ep_square(board) ^
+                hasher.hash_turn(board))
+
+    def push(self, board, move):
+        """Push a legal move onto board and update the key."""
+        rnd = self._random
+        color = int(board.turn)
+        from_sq = move.from_square
+        to_sq = move.to_square
+        piece_type = board.piece_type_at(from_sq)
+
+        # Polyglot piece index is (piece_type - 1) * 2 + color, white = 1
+        h = self.pieces
+        h ^= rnd[64 * ((piece_type - 1) * 2 + color) + from_sq]
+        h ^= rnd[64 * (((move.promotion or piece_type) - 1) * 2 + color) + to_sq]
+
+        if piece_type == chess.KING and board.is_castling(move):
+            rook = 64 * ((chess.ROOK - 1) * 2 + color)
+            if to_sq > from_sq:
+                h ^= rnd[rook + to_sq + 1] ^ rnd[rook + to_sq - 1]
+            else:
+                h ^= rnd[rook + to_sq - 2] ^ rnd[rook + to_sq + 1]
+        else:
+            captured = board.piece_type_at(to_sq)
+            if captured:
+                h ^= rnd[64 * ((captured - 1) * 2 + (1 - color)) + to_sq]
+            elif piece_type == chess.PAWN and to_sq == board.ep_square:
+                cap_sq = to_sq - 8 if color else to_sq + 8
+                h ^= rnd[64 * ((chess.PAWN - 1) * 2 + (1 - color)) + cap_sq]
+
+        board.push(move)
+        self.pieces = h
+        self.key = h ^ self._state(board)
+
+def process_game(sans, position_stats, max_ply=60):
+    """Process a single game's SAN moves and update position statistics."""
+    board = chess.Board()
+    zob = IncrementalZobrist(board)
+    # Bind hot-loop lookups to locals once per game
+    parse_san = board.parse_san
+    push = zob.push
     
-    for i, move in enumerate(moves[:max_ply]):
-        key = chess.polyglot.zobrist_hash(board)
-        
-        move_int = 0
-        move_int |= move.from_square
-        move_int |= (move.to_square << 6)
+    for san in islice(sans, max_ply):
+        move = parse_san(san)
+        key = zob.key
         
-        if move.promotion:
-            promotion_map = {
-                chess.KNIGHT: 1,
-                chess.BISHOP: 2,
-                chess.ROOK: 3,
-                chess.QUEEN: 4
-            }
-            move_int |= (promotion_map.get(move.promotion, 0) << 12)
+        move_int = (move.from_square | (move.to_square << 6)
+                    | (_PROMO[move.promotion or 0] << 12))
         
-        position_stats[key][move_int] += 1
-        board.push(move)
+        # Saturate at the uint16 count ceiling so the writer needs no clamp
+        k = (key, move_int)
+        v = position_stats.get(k, 0)
+        if v < 65535:
+            position_stats[k] = v + 1
+        push(board, move)
 
 def process_single_shard(shard_path, output_bin, max_ply=60):
     """Process a single shard and write its own .bin file."""
     print(f"Processing {shard_path.name}...")
     
-    position_stats = defaultdict(lambda: defaultdict(int))
+    # Flat map of (zobrist_key, move_int) -> count
+    position_stats = {}
     count = 0
     errors = 0
     
-    # Open and process the zst file
-    proc = subprocess.Popen(['zstd', '-dc', str(shard_path)], 
-                          stdout=subprocess.PIPE, 
-                          stderr=subprocess.DEVNULL,
-                          universal_newlines=True,
-                          encoding='utf-8',
-                          errors='ignore')
-    
-    try:
-        while True:
+    # Open and stream-decompress the zst file in-process
+    if _DCTX is None:
+        _init_worker()
+    with open(shard_path, 'rb') as fh, \
+            _DCTX.stream_reader(fh, read_size=ZSTD_READ_SIZE,
+                                read_across_frames=True) as reader:
+        text = io.TextIOWrapper(reader, encoding='utf-8', errors='ignore')
+        for sans in iter_games(text, max_ply):
             try:
-                game = chess.pgn.read_game(proc.stdout)
-                if game is None:
-                    break
-                
-                process_game(game, position_stats, max_ply)
+                process_game(sans, position_stats, max_ply)
                 count += 1
                 
                 if count % 5000 == 0:
-                    print(f"  {count} games...")
+                    print(f"  {shard_path.name}: {count} games...")
                     
             except Exception:
                 errors += 1
                 continue
-    finally:
-        proc.stdout.close()
-        proc.wait()
     
-    print(f"  {count} games, {len(position_stats)} positions")
+    print(f"  {shard_path.name}: {count} games, {len(position_stats)} position/move pairs")
     
-    # Write this shard's book
-    entries = []
-    for key, moves in position_stats.items():
-        for move_int, cnt in moves.items():
-            entries.append((key, move_int, cnt))
+    # Write this shard's book; free the dict before sorting to cap peak RAM
+    entries = np.fromiter(
+        ((key, move_int, cnt, cnt, min(cnt, 32767))
+         for (key, move_int), cnt in position_stats.items()),
+        dtype=ENTRY_DTYPE, count=len(position_stats))
+    position_stats.clear()
     
-    entries.sort()
+    # Sort in place as raw 16-byte records: big-endian (key, move) lead
+    # each record and are unique per shard, so byte order is entry order
+    entries.view('S16').sort()
     
-    with open(output_bin, 'wb') as f:
-        for key, move_int, cnt in entries:
-            entry = struct.pack('>QHHHh', key, move_int, min(cnt, 65535), 
-                              min(cnt, 65535), min(cnt, 32767))
-            f.write(entry)
+    entries.tofile(output_bin)
     
     print(f"  Wrote {len(entries)} entries to {output_bin}")
     return len(entries)
 
-def merge_books(book_files, output_file):
-    """Merge multiple .bin files using a heap-based merge."""
-    print(f"\nMerging {len(book_files)} books...")
+def _init_worker():
+    """Pool initializer: create the worker's long-lived decompressor."""
+    global _DCTX
+    _DCTX = zstandard.ZstdDecompressor()
+
+def _worker(args):
+    """Pool entry point: unpack a (shard, output_bin) task and process it."""
+    shard_path, output_bin = args
+    return output_bin, process_single_shard(shard_path, output_bin)
+
+class BookReader:
+    """
+    Sequential reader over a sorted .bin book. `entries` iterates
+    (key, move, count, n, sum) tuples: blocks are read in bulk and
+    unpacked with struct.iter_unpack, all chained in C, so pulling an
+    entry with the built-in next() runs no Python-level code.
+    """
+
+    def __init__(self, path, start=0, stop=None, block_entries=MERGE_BLOCK_ENTRIES):
+        self.f = open(path, 'rb')
+        # Byte span of the [start, stop) entry range; length 0 means to EOF
+        self.offset = start * ENTRY_STRUCT.size
+        self.length = 0 if stop is None else (stop - start) * ENTRY_STRUCT.size
+        # Reads are strictly sequential; let the kernel read ahead
+        # (posix_fadvise is unavailable on some platforms, e.g. macOS)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.f.fileno(), self.offset, self.length,
+                             os.POSIX_FADV_SEQUENTIAL)
+        self.f.seek(self.offset)
+        read_block = partial(self.f.read, block_entries * ENTRY_STRUCT.size)
+        self.entries = chain.from_iterable(
+            map(ENTRY_STRUCT.iter_unpack, iter(read_block, b'')))
+        if stop is not None:
+            self.entries = islice(self.entries, stop - start)
+
+    def close(self):
+        # Temp books are read once; drop them from the page cache
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.f.fileno(), self.offset, self.length,
+                             os.POSIX_FADV_DONTNEED)
+        self.f.close()
+
+def merge_books(book_files, output_file, ranges=None, quiet=False):
+    """
+    Merge multiple .bin files using a heap-based merge. ranges optionally
+    gives a (start, stop) entry range to read from each book; quiet
+    suppresses progress output (used by parallel workers).
+    """
+    if not quiet:
+        print(f"\nMerging {len(book_files)} books...")
     
-    # Open all book files
-    open_files = []
-    readers = []
+    # Open all book files and read the first entry from each
+    if ranges is None:
+        ranges = [(0, None)] * len(book_files)
+    readers = [BookReader(book_file, start, stop)
+               for book_file, (start, stop) in zip(book_files, ranges)]
     
-    for book_file in book_files:
-        f = open(book_file, 'rb')
-        open_files.append(f)
-        
-        # Read first entry from each file
-        entry = f.read(16)
-        if entry:
-            key, move, count, n, sum_val = struct.unpack('>QHHHh', entry)
-            # heap item: (key, move, count, n, sum, file_index)
-            heapq.heappush(readers, (key, move, count, n, sum_val, len(readers) - 1))
+    # Heap items are [entry, file_index, entries]. The root is refilled in
+    # place and re-sifted with heapreplace, which runs in C.
+    heap = []
+    for file_idx, reader in enumerate(readers):
+        entry = next(reader.entries, None)
+        if entry is not None:
+            heap.append([entry, file_idx, reader.entries])
+    heapq.heapify(heap)
     
-    # Merge using heap
     current_key = None
     current_move = None
     current_count = 0
     current_n = 0
     current_sum = 0
     entries_written = 0
+    pack_into = ENTRY_STRUCT.pack_into
+    outbuf = bytearray(MERGE_OUTPUT_ENTRIES * ENTRY_STRUCT.size)
+    offset = 0
     
     with open(output_file, 'wb') as out:
-        while readers:
-            key, move, count, n, sum_val, file_idx = heapq.heappop(readers)
+        while heap:
+            top = heap[0]
+            key, move, count, n, sum_val = top[0]
             
             if current_key == key and current_move == move:
                 # Combine with current entry
@@ -143,12 +357,15 @@ def merge_books(book_files, output_file):
             else:
                 # Write previous entry if exists
                 if current_key is not None:
-                    entry = struct.pack('>QHHHh', current_key, current_move, 
-                                      current_count, current_n, current_sum)
-                    out.write(entry)
+                    pack_into(outbuf, offset, current_key, current_move, 
+                              current_count, current_n, current_sum)
+                    offset += 16
+                    if offset == len(outbuf):
+                        out.write(outbuf)
+                        offset = 0
                     entries_written += 1
                     
-                    if entries_written % 1000000 == 0:
+                    if not quiet and entries_written % 1000000 == 0:
                         print(f"  Merged {entries_written} entries...")
                 
                 # Start new entry
@@ -159,33 +376,140 @@ def merge_books(book_files, output_file):
                 current_sum = sum_val
             
             # Read next entry from the same file
-            entry = open_files[file_idx].read(16)
-            if entry:
-                key, move, count, n, sum_val = struct.unpack('>QHHHh', entry)
-                heapq.heappush(readers, (key, move, count, n, sum_val, file_idx))
+            entry = next(top[2], None)
+            if entry is None:
+                heapq.heappop(heap)
+            else:
+                top[0] = entry
+                heapq.heapreplace(heap, top)
         
-        # Write final entry
+        # Write final entry and flush the remaining buffer
         if current_key is not None:
-            entry = struct.pack('>QHHHh', current_key, current_move, 
-                              current_count, current_n, current_sum)
-            out.write(entry)
+            pack_into(outbuf, offset, current_key, current_move, 
+                      current_count, current_n, current_sum)
+            offset += 16
             entries_written += 1
+        out.write(memoryview(outbuf)[:offset])
     
     # Close all files
-    for f in open_files:
-        f.close()
+    for reader in readers:
+        reader.close()
+    
+    if not quiet:
+        print(f"  Total entries merged: {entries_written}")
+    return entries_written
+
+def _append_file(out, path):
+    """
+    Append the file at path to the unbuffered file out. Uses
+    os.copy_file_range where available so the data never passes through
+    user space (and is shared, not copied, on reflinking filesystems);
+    falls back to a plain copy from wherever the kernel copy stopped.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        remaining = os.fstat(f.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(f.fileno(), out.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError:
+                pass
+        if remaining > 0:
+            shutil.copyfileobj(f, out, MERGE_BLOCK_ENTRIES * ENTRY_STRUCT.size)
+
+def merge_books_parallel(book_files, output_file, workers=None):
+    """
+    Merge books across processes by splitting the key space. Split keys
+    are sampled from the books; each worker k-way merges one key range
+    from every book into a part file beside output_file, and the parts
+    are stitched together in key order. Equal keys never straddle a split,
+    so every entry is combined exactly as in a single merge_books pass.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(book_files) < 2:
+        return merge_books(book_files, output_file)
+    
+    # Memory-map each book; big-endian keys sort bytewise as 'S8'
+    books = []
+    for book_file in book_files:
+        if os.path.getsize(book_file) > 0:
+            keys = np.memmap(book_file, dtype=ENTRY_DTYPE, mode='r')['key']
+            books.append((book_file, keys))
+    if not books:
+        return merge_books(book_files, output_file)
+    
+    # Choose workers - 1 split keys from evenly spaced samples of every book
+    samples = []
+    for _, keys in books:
+        idx = np.linspace(0, len(keys) - 1, min(len(keys), MERGE_SPLIT_SAMPLES))
+        samples.append(keys[idx.astype(np.int64)].astype(np.uint64))
+    samples = np.sort(np.concatenate(samples))
+    splits = np.unique(samples[(np.arange(1, workers) * len(samples)) // workers])
+    split_bytes = [struct.pack('>Q', int(key)) for key in splits]
+    
+    # Entry boundaries of every key range in every book
+    bounds = []
+    for _, keys in books:
+        raw = keys.view('S8')
+        bounds.append([0] + [int(np.searchsorted(raw, b)) for b in split_bytes] + [len(keys)])
+    
+    tasks = []
+    for part in range(len(split_bytes) + 1):
+        paths, ranges = [], []
+        for (book_file, _), edges in zip(books, bounds):
+            if edges[part] < edges[part + 1]:
+                paths.append(book_file)
+                ranges.append((edges[part], edges[part + 1]))
+        if paths:
+            tasks.append((paths, Path(f"{output_file}.part{part}"), ranges, True))
+    
+    print(f"\nMerging {len(book_files)} books in {len(tasks)} key ranges across {workers} workers...")
+    with multiprocessing.Pool(processes=min(workers, len(tasks))) as pool:
+        counts = pool.starmap(merge_books, tasks)
     
+    # Stitch parts in key order: the first part is renamed into place and
+    # the rest are appended in-kernel, each removed once appended
+    part_files = [part_file for _, part_file, _, _ in tasks]
+    os.replace(part_files[0], output_file)
+    with open(output_file, 'r+b', buffering=0) as out:
+        out.seek(0, os.SEEK_END)
+        for part_file in part_files[1:]:
+            _append_file(out, part_file)
+            part_file.unlink()
+    
+    entries_written = sum(counts)
     print(f"  Total entries merged: {entries_written}")
     return entries_written
 
 def main():
     if len(sys.argv) < 2:
         print("Usage: python3 rebuildBookChunked.py <filtered_dir> [output.bin]")
+        print()
+        print("Shards are processed, and the final merge is split, across")
+        print("BOOK_WORKERS processes (default: CPU count).")
+        print("Each worker holds one shard's position table in memory, so peak RAM")
+        print("grows with the worker count; lower BOOK_WORKERS if the build runs")
+        print("out of memory (BOOK_WORKERS=1 matches the old serial footprint).")
         sys.exit(1)
     
     filtered_dir = Path(sys.argv[1])
     output_file = sys.argv[2] if len(sys.argv) > 2 else "openings.bin"
     
+    workers_env = os.environ.get("BOOK_WORKERS")
+    if workers_env is None:
+        workers = os.cpu_count() or 1
+    else:
+        try:
+            workers = int(workers_env)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            print(f"Error: BOOK_WORKERS must be a positive integer, got {workers_env!r}")
+            sys.exit(1)
+    
     # Find all shards
     shards = sorted(filtered_dir.glob("*.pgn.zst"))
     if not shards:
@@ -199,20 +523,23 @@ def main():
     with tempfile.TemporaryDirectory(prefix="polyglot_") as tmpdir:
         tmpdir = Path(tmpdir)
         print(f"Using temp directory: {tmpdir}")
+        print(f"Using {workers} worker process(es)")
         
-        # Process each shard into its own book
+        # Process shards in parallel, each into its own book
+        tasks = [(shard, tmpdir / f"{shard.stem}.bin") for shard in shards]
         temp_books = []
-        for i, shard in enumerate(shards, 1):
-            print(f"\n[{i}/{len(shards)}] {shard.name}")
-            temp_book = tmpdir / f"{shard.stem}.bin"
-            entries = process_single_shard(shard, temp_book)
-            if entries > 0:
-                temp_books.append(temp_book)
+        with multiprocessing.Pool(processes=workers,
+                                  initializer=_init_worker) as pool:
+            for i, (temp_book, entries) in enumerate(pool.imap_unordered(_worker, tasks), 1):
+                print(f"\n[{i}/{len(shards)}] {temp_book.name} done")
+                if entries > 0:
+                    temp_books.append(temp_book)
+        temp_books.sort()
         
         # Merge all temporary books
         print("\n" + "=" * 50)
         print("Merging all books into final output...")
-        total_entries = merge_books(temp_books, output_file)
+        total_entries = merge_books_parallel(temp_books, output_file, workers)
     
     # Report final stats
     size_mb = os.path.getsize(output_file) / (1024 * 1024)
@@ -229,33 +556,18 @@ def main():
     board.push_san("Nf3")
     target_key = chess.polyglot.zobrist_hash(board)
     
-    with open(output_file, 'rb') as f:
-        # Binary search for verification
-        f.seek(0, 2)
-        file_size = f.tell()
-        num_entries = file_size // 16
-        
-        left, right = 0, num_entries - 1
-        found = False
-        
-        while left <= right:
-            mid = (left + right) // 2
-            f.seek(mid * 16)
-            entry = f.read(16)
-            key = struct.unpack('>Q', entry[:8])[0]
-            
-            if key == target_key:
-                found = True
-                break
-            elif key < target_key:
-                left = mid + 1
-            else:
-                right = mid - 1
-        
-        if found:
-            print("✅ Position after 1.e4 e5 2.Nf3 found in book!")
-        else:
-            print("❌ Position after 1.e4 e5 2.Nf3 NOT found")
+    found = False
+    if total_entries > 0:
+        # Big-endian keys sort bytewise, so searching the raw 8-byte field
+        # avoids a byte-swapped copy of the whole key column
+        book = np.memmap(output_file, dtype=ENTRY_DTYPE, mode='r')
+        idx = np.searchsorted(book['key'].view('S8'), struct.pack('>Q', target_key))
+        found = idx < len(book) and int(book['key'][idx]) == target_key
+    
+    if found:
+        print("✅ Position after 1.e4 e5 2.Nf3 found in book!")
+    else:
+        print("❌ Position after 1.e4 e5 2.Nf3 NOT found")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+Tests for rebuildBookChunked.py.
+Run from the repository root with: python3 -m unittest discover -s scripts
+"""
+
+import io
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+import chess
+import chess.polyglot
+
+import rebuildBookChunked as book
+
+
+def games(pgn, **kwargs):
+    return list(book.iter_games(io.StringIO(pgn), **kwargs))
+
+
+class IterGamesTest(unittest.TestCase):
+    def test_skips_headers_and_move_numbers(self):
+        pgn = '[Event "a"]\n[Result "1-0"]\n\n1. e4 e5 2.Nf3 2...Nc6 1-0\n'
+        self.assertEqual(games(pgn), [['e4', 'e5', 'Nf3', 'Nc6']])
+
+    def test_skips_nested_variations_nags_and_suffixes(self):
+        pgn = '1. e4 (1. d4 d5 (1... Nf6 2. c4)) 1... e5?! $2 (1... c5) 2. Nf3 $1 1-0\n'
+        self.assertEqual(games(pgn), [['e4', 'e5', 'Nf3']])
+
+    def test_skips_multi_line_comments(self):
+        pgn = '1. e4 { a comment\nspanning ( lines } e5 {x} 2. Nf3 1-0\n'
+        self.assertEqual(games(pgn), [['e4', 'e5', 'Nf3']])
+
+    def test_game_without_result_is_flushed_by_next_header(self):
+        pgn = '[Event "a"]\n\n1. e4 e5\n\n[Event "b"]\n\n1. d4 *\n'
+        self.assertEqual(games(pgn), [['e4', 'e5'], ['d4']])
+
+    def test_game_without_result_at_end_of_stream(self):
+        self.assertEqual(games('[Event "a"]\n\n1. c4\n'), [['c4']])
+
+    def test_drops_custom_fen_games(self):
+        pgn = ('[Event "a"]\n[FEN "8/8/8/8/8/8/8/K6k w - - 0 1"]\n\n1. Kb2 *\n\n'
+               '[Event "b"]\n\n1. e4 *\n')
+        self.assertEqual(games(pgn), [['e4']])
+
+    def test_stray_parenthesis_does_not_leak_into_next_game(self):
+        pgn = '1. e4 ) e5 1-0\n\n[Event "y"]\n\n1. d4 (1. c4) d5 1-0\n'
+        self.assertEqual(games(pgn), [['e4', 'e5'], ['d4', 'd5']])
+
+    def test_skips_semicolon_comments_and_escape_lines(self):
+        pgn = ('[Event "a"]\n% escaped 1. h4\n'
+               '1. e4 ; rest {of line\n'
+               'e5 {c; x} 2. Nf3 ; tail\n'
+               '2... Nc6 {open\nstill ; comment} 3. Bb5 1-0\n')
+        self.assertEqual(games(pgn), [['e4', 'e5', 'Nf3', 'Nc6', 'Bb5']])
+
+    def test_semicolon_comment_after_closed_brace_comment(self):
+        pgn = '1. e4 {a} e5 ; c {d\n2. Nf3 Nc6 1-0\n\n[Event "b"]\n\n1. d4 d5 0-1\n'
+        self.assertEqual(games(pgn), [['e4', 'e5', 'Nf3', 'Nc6'], ['d4', 'd5']])
+
+    def test_max_ply_stops_collecting_but_finds_result(self):
+        pgn = '1. e4 e5 2. Nf3 Nc6 1-0\n\n1. d4 *\n'
+        self.assertEqual(games(pgn, max_ply=2), [['e4', 'e5'], ['d4']])
+
+
+class IncrementalZobristTest(unittest.TestCase):
+    def test_matches_zobrist_hash_on_random_games(self):
+        rng = random.Random(5)
+        seen = set()
+        for _ in range(300):
+            board = chess.Board()
+            zob = book.IncrementalZobrist(board)
+            for _ in range(150):
+                moves = list(board.legal_moves)
+                if not moves:
+                    break
+                # Bias towards the moves that need special handling
+                special = [m for m in moves if m.promotion or board.is_castling(m)
+                           or board.is_en_passant(m) or board.is_capture(m)]
+                move = rng.choice(special if special and rng.random() < 0.5 else moves)
+                if move.promotion:
+                    seen.add('promotion')
+                if board.is_castling(move):
+                    seen.add('castling')
+                if board.is_en_passant(move):
+                    seen.add('en passant')
+                zob.push(board, move)
+                self.assertEqual(zob.key, chess.polyglot.zobrist_hash(board), board.fen())
+        self.assertEqual(seen, {'promotion', 'castling', 'en passant'})
+
+
+class MergeBooksParallelTest(unittest.TestCase):
+    def test_matches_serial_merge(self):
+        rng = random.Random(7)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            # Overlapping keys across books so entries get combined
+            pool = [rng.getrandbits(64) for _ in range(3000)]
+            books = []
+            for i in range(6):
+                pairs = {(rng.choice(pool), rng.randrange(4096)) for _ in range(2000)}
+                path = tmpdir / f"book{i}.bin"
+                with open(path, 'wb') as f:
+                    for key, move in sorted(pairs):
+                        count = rng.randrange(1, 65536)
+                        f.write(book.ENTRY_STRUCT.pack(key, move, count, count,
+                                                       min(count, 32767)))
+                books.append(path)
+            books.append(tmpdir / "empty.bin")
+            books[-1].touch()
+
+            serial = tmpdir / "serial.bin"
+            book.merge_books(books, serial)
+            for workers in (2, 3, 5):
+                parallel = tmpdir / f"parallel{workers}.bin"
+                book.merge_books_parallel(books, parallel, workers)
+                self.assertEqual(parallel.read_bytes(), serial.read_bytes())
+            self.assertEqual(list(tmpdir.glob("*.part*")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()